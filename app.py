@@ -2,10 +2,20 @@ import streamlit as st
 import fitz
 import tiktoken
 import re
+import unicodedata
 import time
+import functools
+import bisect
+import os
 from st_copy import copy_button
-from io import BytesIO
-import base64
+from concurrent.futures import ThreadPoolExecutor
+
+# Optional faster BPE backend with the same API and token IDs as tiktoken
+# (special-token strings are always encoded as plain text, see tokenize_and_chunk)
+try:
+    import riptoken
+except ImportError:
+    riptoken = None
 
 # Set page configuration
 st.set_page_config(
@@ -26,41 +36,20 @@ st.markdown("""
         border-radius: 10px;
         margin-bottom: 2rem;
     }
-    .chunk-card {
-        border: 1px solid #e1e4e8;
-        border-radius: 10px;
-        padding: 1.5rem;
-        margin-bottom: 1.5rem;
-        background: white;
-        box-shadow: 0 2px 8px rgba(0,0,0,0.08);
-        transition: transform 0.3s ease, box-shadow 0.3s ease;
-    }
-    .chunk-card:hover {
-        transform: translateY(-2px);
-        box-shadow: 0 4px 12px rgba(0,0,0,0.1);
-    }
-    .chunk-header {
-        display: flex;
-        justify-content: space-between;
-        align-items: center;
-        margin-bottom: 1rem;
-        padding-bottom: 0.5rem;
-        border-bottom: 2px solid #0066cc;
-    }
-    .token-badge {
-        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-        color: white;
-        padding: 0.25rem 0.75rem;
-        border-radius: 12px;
-        font-weight: 500;
-        font-size: 0.9em;
-    }
     .metadata-box {
         background-color: #e9ecef;
         padding: 1rem;
         border-radius: 8px;
         margin: 1rem 0;
     }
+    .summary-row {
+        display: flex;
+        flex-wrap: wrap;
+        gap: 2rem;
+    }
+    .summary-row > div {
+        flex: 1 1 300px;
+    }
     .success-message {
         background-color: #d4edda;
         color: #155724;
@@ -72,91 +61,158 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# Precompiled patterns used by clean_academic_text
+_RE_MULTI_NEWLINE = re.compile(r'\n{3,}')
+_RE_HYPHEN_BREAK = re.compile(r'(\w+)-\s*\n\s*(\w+)')
+
+# Latin ligatures (U+FB00-U+FB06) MuPDF may still emit, e.g. "\ufb01" -> "fi";
+# superscripts, subscripts and other compatibility characters are left intact
+_LIGATURE_TABLE = {cp: unicodedata.normalize("NFKC", chr(cp)) for cp in range(0xFB00, 0xFB07)}
+
 def extract_text_from_academic_pdf(pdf_bytes):
     """
     Extract text from academic PDF using PyMuPDF (fitz) which handles scientific papers better.
     Preserves academic formatting and handles complex layouts common in research papers.
     """
     try:
-        pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
-        full_text = ""
+        page_texts = []
         
-        # Extract text from each page with academic paper optimization
-        for page_num in range(len(pdf_document)):
-            page = pdf_document[page_num]
-            
-            # Use text extraction with flags that preserve academic formatting
-            text = page.get_text("text", flags=fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_PRESERVE_WHITESPACE)
-            
-            # Clean up text specifically for academic papers
-            text = clean_academic_text(text)
-            
-            if text.strip():
-                full_text += text + "\n\n"
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf_document:
+            # Extract text from each page with academic paper optimization;
+            # iterating the document lets each page be released after use
+            for page in pdf_document:
+                page_texts.append(extract_page_text(page))
         
-        pdf_document.close()
-        return full_text.strip()
+        # Expand leftover ligatures and clean the whole document in one pass
+        full_text = "\n\n".join(page_texts).translate(_LIGATURE_TABLE)
+        return clean_academic_text(full_text).strip()
     
     except Exception as e:
         st.error(f"Error extracting text from PDF: {str(e)}")
         return ""
 
+@st.cache_data(show_spinner=False, max_entries=8)
+def extract_text_timed(pdf_bytes):
+    """
+    Cached extract_text_from_academic_pdf.
+    Returns (text, extraction_time, finished_at) so callers can report the
+    original extraction time and tell whether the result was reused.
+    """
+    start_time = time.time()
+    text = extract_text_from_academic_pdf(pdf_bytes)
+    finished_at = time.time()
+    return text, finished_at - start_time, finished_at
+
+def extract_page_text(page):
+    """
+    Extract text from a single page in reading order.
+    On two-column pages, each band between full-width blocks is read left
+    column first, then right column; other pages keep PyMuPDF's block order.
+    """
+    # Use text extraction with flags that preserve academic formatting;
+    # ligatures are expanded so cleanup and tokenization see plain letters
+    blocks = page.get_text("blocks", flags=fitz.TEXT_PRESERVE_WHITESPACE)
+    
+    # Keep text blocks only: (x0, y0, x1, y1, text, block_no, block_type)
+    blocks = [block for block in blocks if block[6] == 0]
+    
+    # Classify blocks against the page's vertical midline:
+    # 0 = left column, 1 = right column, None = spans both. The tolerance
+    # only admits blocks that sit clearly on one side; anything centred on
+    # the midline (page numbers, centred headings) is treated as full-width
+    midline = page.rect.x0 + page.rect.width / 2
+    tolerance = page.rect.width * 0.02
+    
+    def column_of(block):
+        centre = (block[0] + block[2]) / 2
+        if block[2] <= midline + tolerance and centre < midline - tolerance:
+            return 0
+        if block[0] >= midline - tolerance and centre > midline + tolerance:
+            return 1
+        return None
+    
+    columns = [column_of(block) for block in blocks]
+    column_chars = sum(len(block[4]) for block, column in zip(blocks, columns) if column is not None)
+    spanning_chars = sum(len(block[4]) for block, column in zip(blocks, columns) if column is None)
+    is_two_column = columns.count(0) >= 2 and columns.count(1) >= 2 and column_chars > spanning_chars
+    
+    if is_two_column:
+        # Full-width blocks (title, abstract, wide captions) split the page
+        # into horizontal bands; each band is read left column then right
+        # column, and each full-width block follows the band above it
+        spanning_tops = sorted(block[1] for block, column in zip(blocks, columns) if column is None)
+        sort_keys = []
+        for block, column in zip(blocks, columns):
+            band = bisect.bisect_left(spanning_tops, block[1])
+            if column is None:
+                sort_keys.append((band, 1, 0, block[1], block[0]))
+            else:
+                sort_keys.append((band, 0, column, block[1], block[0]))
+        blocks = [block for _, block in sorted(zip(sort_keys, blocks), key=lambda pair: pair[0])]
+    
+    return "\n".join(block[4] for block in blocks)
+
 def clean_academic_text(text):
     """
     Clean extracted text specifically for academic papers:
-    - Fix random spaces in words (common issue in PDF extraction)
     - Preserve academic formatting
     - Remove excessive whitespace but keep paragraph structure
     - Handle hyphenated words properly
     """
     # Remove excessive newlines but preserve paragraph structure
-    text = re.sub(r'\n{3,}', '\n\n', text)
-    
-    # Fix random spaces within words (common in academic PDFs)
-    # This handles cases like "ran dom" -> "random"
-    text = re.sub(r'(\b[a-z]{2,})\s+([a-z]{2,}\b)', r'\1\2', text)
+    text = _RE_MULTI_NEWLINE.sub('\n\n', text)
     
     # Handle hyphenated words at line breaks
-    text = re.sub(r'(\w+)-\s*\n\s*(\w+)', r'\1\2', text)
-    
-    # Remove leading/trailing whitespace from each line
-    lines = [line.strip() for line in text.split('\n') if line.strip()]
+    text = _RE_HYPHEN_BREAK.sub(r'\1\2', text)
     
-    # Reconstruct with proper paragraph spacing
-    cleaned_text = '\n\n'.join(lines)
+    # Remove leading/trailing whitespace from each line, dropping empty ones,
+    # and reconstruct with proper paragraph spacing
+    stripped_lines = (line.strip() for line in text.splitlines())
+    cleaned_text = '\n\n'.join(line for line in stripped_lines if line)
     
     return cleaned_text
 
+@functools.lru_cache(maxsize=4)
+def _get_encoding(encoding_name):
+    """
+    Return the encoder for encoding_name, built once per process.
+    Uses riptoken when installed (disable with USE_RIPTOKEN=0), else tiktoken.
+    """
+    if riptoken is not None and os.environ.get("USE_RIPTOKEN", "1") != "0":
+        return riptoken.get_encoding(encoding_name)
+    return tiktoken.get_encoding(encoding_name)
+
 def count_tokens(text, encoding_name="cl100k_base"):
     """
-    Count tokens using tiktoken encoder, accurate for LLM token limits.
+    Count tokens using the tiktoken-compatible encoder, accurate for LLM token limits.
     """
-    encoding = tiktoken.get_encoding(encoding_name)
-    return len(encoding.encode(text))
+    encoding = _get_encoding(encoding_name)
+    return len(encoding.encode(text, disallowed_special=()))
 
-def split_text_by_tokens(text, max_tokens=8192, encoding_name="cl100k_base"):
+@st.cache_data(show_spinner=False, max_entries=8)
+def tokenize_and_chunk(text, max_tokens=8192, encoding_name="cl100k_base"):
     """
     Split text into chunks of maximum 8,192 tokens using fixed-size chunking.
-    This is the standard approach for preparing text for LLM processing.
+    The text is encoded once; chunk token counts are the slice lengths.
+    Returns (token_count, chunks, chunk_token_counts).
     """
-    encoding = tiktoken.get_encoding(encoding_name)
-    tokens = encoding.encode(text)
-    chunks = []
+    encoding = _get_encoding(encoding_name)
+    # Special-token strings such as <|endoftext|> are encoded as plain text,
+    # which tiktoken would otherwise reject and riptoken already does
+    tokens = encoding.encode(text, disallowed_special=())
     
     # Split into chunks of max_tokens size
-    for i in range(0, len(tokens), max_tokens):
-        chunk_tokens = tokens[i:i + max_tokens]
-        chunk_text = encoding.decode(chunk_tokens)
-        chunks.append(chunk_text)
+    slices = [tokens[i:i + max_tokens] for i in range(0, len(tokens), max_tokens)]
+    chunk_token_counts = [len(chunk_tokens) for chunk_tokens in slices]
     
-    return chunks
-
-def create_download_link(text, filename):
-    """
-    Create a download link for text content
-    """
-    b64 = base64.b64encode(text.encode()).decode()
-    return f'data:text/plain;base64,{b64}'
+    # Decode chunks in parallel; both backends release the GIL in decode
+    if len(slices) > 1:
+        with ThreadPoolExecutor(max_workers=min(os.cpu_count() or 1, len(slices))) as executor:
+            chunks = list(executor.map(encoding.decode, slices))
+    else:
+        chunks = [encoding.decode(chunk_tokens) for chunk_tokens in slices]
+    
+    return len(tokens), chunks, chunk_token_counts
 
 def main():
     # Academic paper themed header
@@ -224,16 +280,21 @@ def main():
             # Extract text with progress
             with st.spinner("🔍 Extracting text from academic paper..."):
                 start_time = time.time()
-                extracted_text = extract_text_from_academic_pdf(pdf_bytes)
-                extraction_time = time.time() - start_time
+                extracted_text, extraction_time, extracted_at = extract_text_timed(pdf_bytes)
+            
+            # A result finished before this run started came from the cache
+            time_note = " (cached result reused)" if extracted_at < start_time else ""
             
             if not extracted_text:
                 st.error("❌ No text could be extracted. This might be a scanned/image-based PDF.")
                 st.stop()
             
+            # Split text into chunks
+            with st.spinner(f"✂️ Splitting into {max_tokens}-token chunks..."):
+                token_count, chunks, chunk_token_counts = tokenize_and_chunk(extracted_text, max_tokens, encoding_name)
+            
             # Show extraction stats
             char_count = len(extracted_text)
-            token_count = count_tokens(extracted_text, encoding_name)
             avg_words_per_token = 0.75  # Approximate for academic text
             estimated_words = int(token_count * avg_words_per_token)
             
@@ -243,14 +304,10 @@ def main():
                 • Characters: {char_count:,}<br>
                 • Tokens (using {encoding_name}): {token_count:,}<br>
                 • Estimated Words: {estimated_words:,}<br>
-                • Processing Time: {extraction_time:.2f} seconds
+                • Processing Time: {extraction_time:.2f} seconds{time_note}
             </div>
             """, unsafe_allow_html=True)
             
-            # Split text into chunks
-            with st.spinner(f"✂️ Splitting into {max_tokens}-token chunks..."):
-                chunks = split_text_by_tokens(extracted_text, max_tokens, encoding_name)
-            
             # Show chunking results
             num_chunks = len(chunks)
             st.success(f"✅ Successfully created {num_chunks} chunks!")
@@ -258,107 +315,83 @@ def main():
             # Display chunks with copy functionality
             st.subheader("📑 Text Chunks (Copyable)")
             
-            for i, chunk in enumerate(chunks, 1):
-                chunk_tokens = count_tokens(chunk, encoding_name)
+            for i, (chunk, chunk_tokens) in enumerate(zip(chunks, chunk_token_counts), 1):
                 chunk_words = int(chunk_tokens * avg_words_per_token)
                 
-                # Create chunk container
-                st.markdown(f"""
-                <div class="chunk-card">
-                    <div class="chunk-header">
-                        <h4>Chunk {i} of {num_chunks}</h4>
-                        <span class="token-badge">📊 {chunk_tokens:,} tokens | ~{chunk_words:,} words</span>
-                    </div>
-                """, unsafe_allow_html=True)
-                
-                # Text preview (first 300 characters)
-                preview = chunk[:300] + "..." if len(chunk) > 300 else chunk
-                st.text_area(
-                    f"Preview - Chunk {i}",
-                    preview,
-                    height=150,
-                    disabled=True,
-                    key=f"preview_{i}"
-                )
-                
-                # Copy button using st-copy
-                copy_button(
-                    text=chunk,
-                    icon='material_symbols',  # Google Material Symbols icon
-                    tooltip=f'Copy Chunk {i} to Clipboard',
-                    copied_label='✅ Copied!',
-                    key=f'copy_chunk_{i}'
-                )
-                
-                # Additional info about the chunk
-                st.caption(f"Chunk {i} contains academic content including text, references, and formulas from your paper.")
-                
-                st.markdown("</div>", unsafe_allow_html=True)
-                
-                # Add spacing between chunks
-                if i < num_chunks:
-                    st.divider()
+                # Collapsible chunk container; only the first chunks start open
+                with st.expander(
+                    f"Chunk {i} of {num_chunks} — 📊 {chunk_tokens:,} tokens | ~{chunk_words:,} words",
+                    expanded=(i <= 2)
+                ):
+                    # Text preview (first 300 characters)
+                    preview = chunk[:300] + "..." if len(chunk) > 300 else chunk
+                    st.text(preview)
+                    
+                    # Copy button using st-copy
+                    copy_button(
+                        text=chunk,
+                        icon='material_symbols',  # Google Material Symbols icon
+                        tooltip=f'Copy Chunk {i} to Clipboard',
+                        copied_label='✅ Copied!',
+                        key=f'copy_chunk_{i}'
+                    )
+                    
+                    # Additional info about the chunk
+                    st.caption(f"Chunk {i} contains academic content including text, references, and formulas from your paper.")
             
             # Summary section
             st.markdown("---")
             st.subheader("📊 Processing Summary")
             
-            summary_col1, summary_col2 = st.columns(2)
-            
-            with summary_col1:
-                st.markdown("### 📈 Statistics")
-                st.markdown(f"""
-                - **Total Chunks:** {num_chunks}
-                - **Total Tokens:** {token_count:,}
-                - **Average Tokens per Chunk:** {token_count // num_chunks if num_chunks > 0 else 0:,}
-                - **Token Limit per Chunk:** {max_tokens:,}
-                - **Processing Time:** {extraction_time:.2f} seconds
-                """)
-            
-            with summary_col2:
-                st.markdown("### 💡 Academic Paper Insights")
-                st.markdown("""
-                - **Chunking Strategy:** Fixed-size token splitting preserves academic content structure
-                - **Text Extraction:** PyMuPDF optimized for scientific documents and equations
-                - **Token Counting:** Uses tiktoken for accurate LLM token limits
-                - **Copy Functionality:** One-click copy with visual feedback using st-copy
-                - **Best Practice:** Each chunk contains complete academic concepts where possible
-                """)
+            st.markdown(f"""
+            <div class="summary-row">
+                <div>
+                    <h3>📈 Statistics</h3>
+                    • <strong>Total Chunks:</strong> {num_chunks}<br>
+                    • <strong>Total Tokens:</strong> {token_count:,}<br>
+                    • <strong>Average Tokens per Chunk:</strong> {token_count // num_chunks if num_chunks > 0 else 0:,}<br>
+                    • <strong>Token Limit per Chunk:</strong> {max_tokens:,}<br>
+                    • <strong>Processing Time:</strong> {extraction_time:.2f} seconds{time_note}
+                </div>
+                <div>
+                    <h3>💡 Academic Paper Insights</h3>
+                    • <strong>Chunking Strategy:</strong> Fixed-size token splitting preserves academic content structure<br>
+                    • <strong>Text Extraction:</strong> PyMuPDF optimized for scientific documents and equations<br>
+                    • <strong>Token Counting:</strong> Uses tiktoken (or riptoken when installed) for accurate LLM token limits<br>
+                    • <strong>Copy Functionality:</strong> One-click copy with visual feedback using st-copy<br>
+                    • <strong>Best Practice:</strong> Each chunk contains complete academic concepts where possible
+                </div>
+            </div>
+            """, unsafe_allow_html=True)
             
             # Bulk download option
             st.markdown("---")
             st.subheader("📦 Bulk Operations")
             
-            col1, col2 = st.columns(2)
+            # Download all chunks as single file
+            all_chunks = "\n\n" + "\n\n".join([
+                f"=== CHUNK {i+1} ({chunk_tokens:,} tokens) ===\n{chunk}"
+                for i, (chunk, chunk_tokens) in enumerate(zip(chunks, chunk_token_counts))
+            ])
             
-            with col1:
-                # Download all chunks as single file
-                all_chunks = "\n\n" + "\n\n".join([
-                    f"=== CHUNK {i+1} ({count_tokens(chunk, encoding_name):,} tokens) ===\n{chunk}"
-                    for i, chunk in enumerate(chunks)
-                ])
-                
-                download_link = create_download_link(all_chunks, f"all_chunks_{uploaded_file.name.replace('.pdf', '.txt')}")
-                st.markdown(f"""
-                    <a href="{download_link}" download="all_chunks_{uploaded_file.name.replace('.pdf', '.txt')}" 
-                       style="display: block; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); 
-                              color: white; text-align: center; padding: 12px; border-radius: 8px; 
-                              text-decoration: none; font-weight: 500; margin: 10px 0;">
-                       💾 Download All Chunks as Single File
-                    </a>
-                """, unsafe_allow_html=True)
+            st.download_button(
+                "💾 Download All Chunks as Single File",
+                data=all_chunks.encode("utf-8"),
+                file_name=f"all_chunks_{uploaded_file.name.replace('.pdf', '.txt')}",
+                mime="text/plain",
+                key="download_all_chunks"
+            )
             
-            with col2:
-                st.markdown("""
-                <div style="background-color: #e3f2fd; padding: 1rem; border-radius: 8px; height: 100%;">
-                    <strong>⚠️ Important Notes:</strong><br>
-                    • Academic papers often contain complex formatting<br>
-                    • Equations, tables, and figures may not extract perfectly<br>
-                    • For scanned PDFs, consider OCR before processing<br>
-                    • 8,192 tokens is optimal for most modern LLMs<br>
-                    • Copy functionality requires HTTPS when deployed
-                </div>
-                """, unsafe_allow_html=True)
+            st.markdown("""
+            <div style="background-color: #e3f2fd; padding: 1rem; border-radius: 8px; margin-top: 1rem;">
+                <strong>⚠️ Important Notes:</strong><br>
+                • Academic papers often contain complex formatting<br>
+                • Equations, tables, and figures may not extract perfectly<br>
+                • For scanned PDFs, consider OCR before processing<br>
+                • 8,192 tokens is optimal for most modern LLMs<br>
+                • Copy functionality requires HTTPS when deployed
+            </div>
+            """, unsafe_allow_html=True)
         
         except Exception as e:
             st.error(f"❌ Error processing document: {str(e)}")